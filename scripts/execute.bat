@@ -4,5 +4,5 @@ setlocal
 SET scriptpath=%dp0
 
 call activate hand-calibration
-python %scriptpath%\..\src\camera\keypoint_gui.py %1 %2 %3 %4
+python %scriptpath%\..\src\camera\keypoint_gui.py %*
 call conda deactivate
\ No newline at end of file
@@ -1,5 +1,5 @@
 #!/bin/sh
 
 conda activate hand-calibration
-python3 src/camera/keypoint_gui.py $1 $2 $3 $4
+python3 src/camera/keypoint_gui.py "$@"
 conda deactivate
\ No newline at end of file
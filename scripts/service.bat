@@ -0,0 +1,8 @@
+@echo off
+setlocal
+
+SET scriptpath=%dp0
+
+call activate hand-calibration
+python %scriptpath%\..\src\camera\calibration_service.py %*
+call conda deactivate
\ No newline at end of file
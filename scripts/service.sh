@@ -0,0 +1,5 @@
+#!/bin/sh
+
+conda activate hand-calibration
+python3 src/camera/calibration_service.py "$@"
+conda deactivate
\ No newline at end of file
@@ -0,0 +1,165 @@
+import csv
+import os
+import sys
+import argparse
+import time
+import numpy as np
+import yaml
+
+# libyaml based loader is an order of magnitude faster, fall back to the pure python one
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+KEYPOINT_NAMES = [
+    "palm_ref0",  "palm_ref1",
+    "Th_TM",      "Ind_MCP",    "Mid_MCP", "Ring_MCP", "Lit_MCP",
+    "Th_MCP",     "Th_IP",      "Th_TIP",
+    "Ind_PIP",    "Ind_DIP",    "Ind_TIP",
+    "Mid_PIP",    "Mid_DIP",    "Mid_TIP",
+    "Ring_PIP",   "Ring_DIP",   "Ring_TIP",
+    "Lit_PIP", "Lit_DIP", "Lit_TIP",
+]
+
+META_COLUMNS = ["subject", "source", "camera_calibration", "timestamp"]
+
+DEFAULT_CALIB_PATH = os.path.join(os.path.dirname(__file__), '..', 'default_calib.yaml')
+
+
+### PUBLIC FUNCTIONS ###
+
+# Loads a calibration yaml (e.g. handcalib.yaml) using the fastest available loader
+def load_calib(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+# Flattens a nested calibration dict into {"thumb.proximal": 0.05, "palm_link_distances.thumb.x": ...}
+def flatten_calib(calib, prefix=''):
+    flat = {}
+    for key, value in calib.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_calib(value, prefix=f"{name}."))
+        else:
+            flat[name] = float(value)
+    return flat
+
+# Returns the column layout of the dataset: metadata, calibration values and keypoint pixel coordinates
+def dataset_columns(default_calib_path=DEFAULT_CALIB_PATH):
+    calib_columns = list(flatten_calib(load_calib(default_calib_path)).keys())
+    keypoint_columns = [f"px.{name}.{axis}" for name in KEYPOINT_NAMES for axis in ('x', 'y')]
+    return META_COLUMNS + calib_columns + keypoint_columns
+
+# Builds one dataset row from a calibration dict and (optionally) the clicked keypoints {name: (x, y)}
+def make_row(calib, keypoints=None, subject='', source='', camera_calibration='', timestamp=None):
+    row = {
+        "subject": subject,
+        "source": source,
+        "camera_calibration": camera_calibration,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S') if timestamp is None else timestamp,
+    }
+    row.update(flatten_calib(calib))
+    if keypoints is not None:
+        for name, (x, y) in keypoints.items():
+            row[f"px.{name}.x"] = float(x)
+            row[f"px.{name}.y"] = float(y)
+    return row
+
+# Appends rows to a csv dataset. The header is written if the file is new, otherwise it has to match
+def append_rows(path, rows, columns=None):
+    if columns is None:
+        columns = dataset_columns()
+
+    new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+    if not new_file:
+        with open(path, 'r', newline='') as f:
+            header = next(csv.reader(f))
+        if header != columns:
+            raise ValueError(f'Columns of dataset "{path}" do not match the expected layout')
+
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval='', extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+# Writes rows as one array per column to a compressed npz file. Missing values become NaN.
+# With append the rows are added to the columns of an existing file, which then has to match
+def save_npz(path, rows, columns=None, append=False):
+    if columns is None:
+        columns = dataset_columns()
+
+    arrays = {}
+    for col in columns:
+        if col in META_COLUMNS:
+            arrays[col] = np.array([str(row.get(col, '')) for row in rows], dtype=str)
+        else:
+            arrays[col] = np.array([row.get(col, np.nan) for row in rows], dtype=np.float64)
+
+    if append and os.path.isfile(path):
+        with np.load(path) as existing:
+            if list(existing.files) != columns:
+                raise ValueError(f'Columns of dataset "{path}" do not match the expected layout')
+            arrays = {col: np.concatenate([existing[col], arrays[col]]) for col in columns}
+    np.savez_compressed(path, **arrays)
+
+# Converts existing calibration yaml files into rows. The subject defaults to the parent directory name.
+# Files that cannot be read or contain non-numeric values are reported and skipped
+def convert_yaml_files(paths):
+    for path in paths:
+        path = os.path.abspath(path)
+        subject = os.path.basename(os.path.dirname(path))
+        try:
+            row = make_row(
+                load_calib(path),
+                subject=subject,
+                source=path,
+                timestamp=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(path)))
+            )
+        except (OSError, yaml.YAMLError, AttributeError, TypeError, ValueError) as e:
+            print(f'[ERROR]: skipping calibration file "{path}": {e}')
+            continue
+        yield row
+
+
+### PRIVATE FUNCTIONS ###
+
+# Expands directories to all calibration files with the given name below them
+def __collectFiles(inputs, filename):
+    files = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            for root, _, names in os.walk(inp):
+                if filename in names:
+                    files.append(os.path.join(root, filename))
+        else:
+            files.append(inp)
+    return sorted(files)
+
+
+### MAIN FUNCTION ###
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help="Calibration files or directories to search for calibration files")
+    parser.add_argument('-o', '--output', type=str, help="Path of the dataset to write (defaults to hand_calibrations.csv)", default='hand_calibrations.csv')
+    parser.add_argument('-f', '--format', choices=['csv', 'npz'], help="Format of the dataset (defaults to csv)", default='csv')
+    parser.add_argument('-a', '--append', action='store_true', help="Append to an existing dataset instead of overwriting it")
+    parser.add_argument('-n', '--name', type=str, help="File name to search for in directories (defaults to handcalib.yaml)", default='handcalib.yaml')
+    args = parser.parse_args()
+
+    files = __collectFiles(args.inputs, args.name)
+    if len(files) == 0:
+        print(f'[FATAL ERROR]: no calibration files found in {args.inputs}!')
+        sys.exit(-1)
+
+    print(f'Converting {len(files)} calibration files')
+    columns = dataset_columns()
+    if args.format == 'csv':
+        if not args.append and os.path.isfile(args.output):
+            os.remove(args.output)
+        append_rows(args.output, convert_yaml_files(files), columns)
+    else:
+        save_npz(args.output, list(convert_yaml_files(files)), columns, append=args.append)
+    print(f'Dataset saved under path: {os.path.abspath(args.output)}')
@@ -0,0 +1,206 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+import argparse
+import cv2
+import numpy as np
+import distance_estimation
+
+
+# Maximum length of one request or response line, large enough for big batches and base64 encoded frames
+STREAM_LIMIT = 64 * 1024 * 1024
+
+# Keeps camera calibration, board pose and camera open and answers newline delimited json requests.
+# Every request is a json object on one line with a `cmd` field and optionally an `id` that is echoed back:
+#   {"cmd": "to_world", "points": [[x, y], ...]}          -> {"ok": true, "points": [[x, y, z], ...]}
+#   {"cmd": "distances", "pairs": [[[x, y], [x, y]], ...]} -> {"ok": true, "distances": [d, ...]}
+#   {"cmd": "capture", "path": "frame.png"}                -> {"ok": true, "path": ..., "shape": [h, w, c]}
+#   {"cmd": "capture"}                                     -> {"ok": true, "png": <base64>, "shape": [h, w, c]}
+#   {"cmd": "ping"}                                        -> {"ok": true}
+class CalibrationService:
+    def __init__(self, calib_path, device=None, flush_frames=5) -> None:
+        self.calib_path = calib_path
+        self.camera_matrix, self.rotation_matrix, self.translation_vector = distance_estimation.load_board_pose(calib_path)
+
+        self.camera = None
+        self.flush_frames = flush_frames
+        self.camera_lock = asyncio.Lock()
+        if device is not None:
+            print('Wait for camera...')
+            self.camera = cv2.VideoCapture(device)
+            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
+            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
+
+        self.handlers = {
+            'ping': self.ping,
+            'to_world': self.to_world,
+            'distances': self.distances,
+            'capture': self.capture,
+        }
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+    async def handle_request(self, request):
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'Request has to be a json object'}
+
+        handler = self.handlers.get(request.get('cmd')) if isinstance(request.get('cmd'), str) else None
+        if handler is None:
+            response = {'ok': False, 'error': f"Unknown command, expected one of {list(self.handlers)}"}
+        else:
+            try:
+                response = await handler(request)
+            except Exception as e:
+                response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The rest of the oversized line cannot be told apart from the next request, so give up the connection
+                    response = {'ok': False, 'error': f"Request exceeds the limit of {STREAM_LIMIT} bytes"}
+                    writer.write(json.dumps(response).encode() + b'\n')
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'ok': False, 'error': f"Invalid json: {e}"}
+                else:
+                    response = await self.handle_request(request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def ping(self, request):
+        return {'ok': True}
+
+    async def to_world(self, request):
+        world = distance_estimation.points_to_world(request['points'], self.camera_matrix, self.rotation_matrix, self.translation_vector)
+        return {'ok': True, 'points': world.tolist()}
+
+    async def distances(self, request):
+        pairs = np.asarray(request['pairs'], dtype=np.float64).reshape(-1, 2, 2)
+        world = distance_estimation.points_to_world(pairs.reshape(-1, 2), self.camera_matrix, self.rotation_matrix, self.translation_vector)
+        world = world.reshape(-1, 2, 3)
+        # Distances are measured in the board plane, like distance_estimation.estimate_distance
+        dists = np.linalg.norm(world[:, 0, :2] - world[:, 1, :2], axis=1)
+        return {'ok': True, 'distances': dists.tolist()}
+
+    async def capture(self, request):
+        if self.camera is None:
+            return {'ok': False, 'error': 'Service was started without a camera device'}
+
+        # Camera reads and encoding block, so they run in a worker thread while other requests are served
+        loop = asyncio.get_running_loop()
+        async with self.camera_lock:
+            ok, image = await loop.run_in_executor(None, self.grab_frame)
+        if not ok:
+            return {'ok': False, 'error': 'Could not grab image'}
+
+        response = {'ok': True, 'shape': list(image.shape)}
+        if 'path' in request:
+            await loop.run_in_executor(None, cv2.imwrite, request['path'], image)
+            response['path'] = os.path.abspath(request['path'])
+        else:
+            response['png'] = await loop.run_in_executor(None, self.encode_png, image)
+        return response
+
+    # The camera buffers frames while the service is idle, so drop them to return a current frame
+    def grab_frame(self):
+        for _ in range(self.flush_frames):
+            self.camera.grab()
+        return self.camera.read()
+
+    def encode_png(self, image):
+        _, png = cv2.imencode('.png', image)
+        return base64.b64encode(png.tobytes()).decode('ascii')
+
+
+### PUBLIC FUNCTIONS ###
+
+async def serve(calib_path, socket_path=None, host='127.0.0.1', port=8765, device=None):
+    service = CalibrationService(calib_path, device=device)
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, path=socket_path, limit=STREAM_LIMIT)
+        print(f'Calibration service listening on {socket_path}')
+    else:
+        server = await asyncio.start_server(service.handle_connection, host=host, port=port, limit=STREAM_LIMIT)
+        print(f'Calibration service listening on {host}:{port}')
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+# Sends a batch of requests over one connection and returns the responses in the same order
+async def send_requests(requests, socket_path=None, host='127.0.0.1', port=8765):
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+    else:
+        reader, writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT)
+
+    try:
+        for request in requests:
+            writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+
+        responses = []
+        for _ in requests:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                line = b''
+                error = f"Response exceeds the limit of {STREAM_LIMIT} bytes"
+            else:
+                error = 'Connection closed by the service'
+            if not line:
+                # The connection is unusable from here on, so all remaining requests fail
+                responses += [{'ok': False, 'error': error}] * (len(requests) - len(responses))
+                break
+            responses.append(json.loads(line))
+        return responses
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+# Blocking convenience wrapper around send_requests for a single request
+def request(message, socket_path=None, host='127.0.0.1', port=8765):
+    return asyncio.run(send_requests([message], socket_path=socket_path, host=host, port=port))[0]
+
+
+### MAIN FUNCTION ###
+if __name__ == "__main__":
+    dirname = os.path.dirname(__file__)
+    default_calib = os.path.normpath(os.path.join(dirname, os.pardir, 'calibration.npy'))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--calibration', type=str, help=f"Path to camera calibration (defaults to {default_calib})", default=default_calib)
+    parser.add_argument('-d', '--device', type=int, help="Camera device number to keep open for capture requests (optional)", default=None)
+    ex_group = parser.add_mutually_exclusive_group()
+    ex_group.add_argument('-s', '--socket', type=str, help="Path of a unix socket to listen on")
+    ex_group.add_argument('-p', '--port', type=int, help="Localhost port to listen on (defaults to 8765)", default=8765)
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.calibration):
+        print(f'[FATAL ERROR]: calibration file "{args.calibration}" does not exists or is not a file!')
+        sys.exit(-1)
+
+    try:
+        asyncio.run(serve(args.calibration, socket_path=args.socket, port=args.port, device=args.device))
+    except KeyboardInterrupt:
+        print('Stopped calibration service')
@@ -26,8 +26,8 @@ def get_palm_axis_offset_euclidian(ref, palm, other):
     r = project_point_on_line(p1, p2, p3)
 
     try:
-        x = int(p3[0] - r[0])
-        y = int(r[1] -  p2[1])
+        x = float(p3[0] - r[0])
+        y = float(r[1] - p2[1])
     except ValueError:
         print(f"p1: {p1}, p2: {p2}, r: {r}")
 
@@ -37,6 +37,24 @@ def get_palm_axis_offset_euclidian(ref, palm, other):
 def project_point_on_line(a, b, p):
     return a + np.dot(p-a, b-a) / np.dot(b-a, b-a) * (b-a)
 
+# Loads the camera calibration and solves the board pose once, so it can be reused for many points
+def load_board_pose(calib_path):
+    camera_matrix, dist_coeff, corners, board_size, corner_size = camera_calibration.load_camera_params(calib_path=calib_path)
+    rotation_matrix, translation_vector = __solveBoardPose(camera_matrix, dist_coeff, corners, board_size, corner_size)
+    return camera_matrix, rotation_matrix, translation_vector
+
+# Projects a (N, 2) array of image points onto the board plane (z = 0) and returns a (N, 3) array of world points
+def points_to_world(image_points, camera_matrix, rotation_matrix, translation_vector):
+    image_points = np.asarray(image_points, dtype=np.float64).reshape(-1, 2)
+    ip = np.vstack([image_points.T, np.ones(len(image_points))])
+    r_inv = np.linalg.inv(rotation_matrix)
+    c_inv = np.linalg.inv(camera_matrix)
+    # Same equation as in __pointToWorld, solved for all points at once
+    tempMat = r_inv @ c_inv @ ip
+    tempMat2 = r_inv @ np.asarray(translation_vector, dtype=np.float64).reshape(3, 1)
+    s = tempMat2[2, 0] / tempMat[2]
+    return (s * tempMat - tempMat2).T
+
 ### PRIVATE FUNCTIONS ###
 
 # imshow mouse event
@@ -110,6 +128,16 @@ def __estimateDistanceSimple(points, corners, board_size, corner_size):
 
 # Estimates the distance between two point. There is no assumption regarding the camera position
 def __estimateDistance(points, camera_matrix, distortion_coeff, corners, board_size, corner_size):
+    r, tVec = __solveBoardPose(camera_matrix, distortion_coeff, corners, board_size, corner_size)
+    # Points to world points
+    p1 = __pointToWorld(points[0], camera_matrix, r, tVec)
+    p2 = __pointToWorld(points[1], camera_matrix, r, tVec)
+    # Calculate euclidean distance
+    distance = __euclideanDistance(p1, p2)
+    return distance
+
+# Returns the rotation matrix and translation vector of the checkerboard
+def __solveBoardPose(camera_matrix, distortion_coeff, corners, board_size, corner_size):
     corners = corners[0]
     # Get known world points of the checkerboard corners
     boardColumns, boardRows = board_size
@@ -121,12 +149,7 @@ def __estimateDistance(points, camera_matrix, distortion_coeff, corners, board_s
     _, rVec, tVec = cv2.solvePnP(board_points_3D, corners, camera_matrix, distortion_coeff)
     # Calculate rotation matrix
     r, _ = cv2.Rodrigues(rVec)
-    # Points to world points
-    p1 = __pointToWorld(points[0], camera_matrix, r, tVec)
-    p2 = __pointToWorld(points[1], camera_matrix, r, tVec)
-    # Calculate euclidean distance
-    distance = __euclideanDistance(p1, p2)
-    return distance
+    return r, tVec
 
 # Returns the euclidean distance of two points
 def __euclideanDistance(p1, p2):
@@ -0,0 +1,202 @@
+import numpy as np
+
+
+FINGER_KEYPOINTS = {
+    'thumb':  ["Th_TM",    "Th_MCP",   "Th_IP",    "Th_TIP"],
+    'index':  ["Ind_MCP",  "Ind_PIP",  "Ind_DIP",  "Ind_TIP"],
+    'middle': ["Mid_MCP",  "Mid_PIP",  "Mid_DIP",  "Mid_TIP"],
+    'ring':   ["Ring_MCP", "Ring_PIP", "Ring_DIP", "Ring_TIP"],
+    'little': ["Lit_MCP",  "Lit_PIP",  "Lit_DIP",  "Lit_TIP"],
+}
+FINGERS  = list(FINGER_KEYPOINTS.keys())
+SEGMENTS = ['proximal', 'middle', 'distal']
+PALM_REFS = ["palm_ref0", "palm_ref1"]
+
+PALM_AXES = ['x', 'z']
+
+
+### PUBLIC FUNCTIONS ###
+
+# Fits the kinematic hand model of default_calib.yaml to all keypoints at once by least squares in the board plane.
+# points maps keypoint names to (x, y) board coordinates in [m], x_direction optionally gives the positive
+# direction of the palm axis (defaults to palm_ref0 -> palm_ref1).
+# All fingers share one palm frame, which is spanned by the palm refs and the palm_link. The finger bases are the
+# palm_link_distances of default_calib scaled by one palm scale per axis, like the hand model applies scales.palm,
+# and every finger starts at its modelled base. By default every link has its own direction. With straight_fingers,
+# which suits a hand lying flat on the board, all links of a finger share one direction.
+# Both models have fewer parameters than keypoint coordinates, the residuals are given in [m].
+# The palm z offsets are signed: positive on the side of the palm axis where Mid_MCP lies
+def fit_hand_model(points, default_calib, x_direction=None, straight_fingers=False, max_iter=50, tol=1e-10):
+    observed = np.array([[points[name] for name in FINGER_KEYPOINTS[finger]] for finger in FINGERS], dtype=np.float64)[..., :2]
+    refs = np.array([points[name] for name in PALM_REFS], dtype=np.float64)[:, :2]
+    default_offsets = np.array([[default_calib['palm_link_distances'][finger][k] for k in PALM_AXES] for finger in FINGERS], dtype=np.float64)
+    layout = __layout(straight_fingers, default_offsets)
+
+    params, handedness = __initialParams(observed, refs, x_direction, layout)
+
+    def residual_fn(batch):
+        return __residuals(batch, observed, refs, handedness, layout)
+
+    params, iterations, converged = __levenbergMarquardt(residual_fn, params, max_iter, tol)
+
+    palm_scales, lengths, _ = __unpack(params[None], layout)
+    palm_scales, lengths = palm_scales[0], lengths[0]
+    offsets = palm_scales * default_offsets
+
+    calib = {'palm_link_distances': {}, 'scales': {}}
+    for i, finger in enumerate(FINGERS):
+        calib[finger] = {seg: float(lengths[i, j]) for j, seg in enumerate(SEGMENTS)}
+        calib['palm_link_distances'][finger] = {k: float(offsets[i, a]) for a, k in enumerate(PALM_AXES)}
+        calib['scales'][finger] = {k: calib[finger][k]/default for k, default in default_calib[finger].items()}
+    calib['scales']['palm'] = {'z': float(palm_scales[1]), 'x': float(palm_scales[0])}
+
+    # Distance of each keypoint to the model, palm refs are measured to the palm axis
+    predicted, origin, _, normal = __forward(params[None], handedness, layout)
+    point_residuals = np.linalg.norm(predicted[0] - observed, axis=-1)
+    ref_residuals = np.abs((refs - origin[0]) @ normal[0])
+
+    residuals = {name: float(ref_residuals[i]) for i, name in enumerate(PALM_REFS)}
+    for i, finger in enumerate(FINGERS):
+        for j, name in enumerate(FINGER_KEYPOINTS[finger]):
+            residuals[name] = float(point_residuals[i, j])
+
+    return {
+        'calib': calib,
+        'residuals': residuals,
+        'rms': float(np.sqrt(np.mean(np.square(list(residuals.values()))))),
+        'iterations': iterations,
+        'converged': converged,
+    }
+
+
+### PRIVATE FUNCTIONS ###
+
+# Parameter layout: palm axis angle, palm_link origin, palm scales (x, z), link lengths and link angles,
+# one angle per finger with straight fingers or one per link otherwise
+def __layout(straight_fingers, default_offsets):
+    n_angles = len(FINGERS) if straight_fingers else len(FINGERS) * len(SEGMENTS)
+    lengths = slice(5, 5 + len(FINGERS) * len(SEGMENTS))
+    return {
+        'theta': 0,
+        'origin': slice(1, 3),
+        'palm_scales': slice(3, 5),
+        'lengths': lengths,
+        'angles': slice(lengths.stop, lengths.stop + n_angles),
+        'straight_fingers': straight_fingers,
+        'default_offsets': default_offsets,
+    }
+
+# Splits a (B, P) parameter batch into palm scales (B, 2), link lengths (B, 5, 3) and link angles (B, 5, 3)
+def __unpack(params, layout):
+    palm_scales = params[:, layout['palm_scales']]
+    lengths = params[:, layout['lengths']].reshape(-1, len(FINGERS), len(SEGMENTS))
+    angles = params[:, layout['angles']].reshape(len(params), len(FINGERS), -1)
+    angles = np.broadcast_to(angles, lengths.shape)
+    return palm_scales, lengths, angles
+
+# Returns the predicted (B, 5, 4, 2) keypoints of all fingers and the palm frame of a parameter batch
+def __forward(params, handedness, layout):
+    theta = params[:, layout['theta']]
+    axis = np.stack([np.cos(theta), np.sin(theta)], axis=-1)
+    normal = handedness * np.stack([-np.sin(theta), np.cos(theta)], axis=-1)
+    origin = params[:, layout['origin']]
+    palm_scales, lengths, angles = __unpack(params, layout)
+
+    offsets = palm_scales[:, None] * layout['default_offsets'][None]
+    bases = origin[:, None] + offsets[..., 0, None] * axis[:, None] + offsets[..., 1, None] * normal[:, None]
+    links = lengths[..., None] * np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+    joints = bases[:, :, None] + np.cumsum(links, axis=2)
+    return np.concatenate([bases[:, :, None], joints], axis=2), origin, axis, normal
+
+# Residuals in [m] of a (B, P) parameter batch: keypoints and palm refs on the palm axis
+def __residuals(params, observed, refs, handedness, layout):
+    predicted, origin, _, normal = __forward(params, handedness, layout)
+    r_points = (predicted - observed).reshape(len(params), -1)
+    r_refs = np.einsum('bij,bj->bi', refs[None] - origin[:, None], normal)
+    return np.concatenate([r_points, r_refs], axis=1)
+
+# Initializes all parameters from the keypoints: the palm frame by linear least squares on the finger bases,
+# the links from the modelled bases to the observed joints
+def __initialParams(observed, refs, x_direction, layout):
+    axis = refs[1] - refs[0]
+    axis = axis / np.linalg.norm(axis)
+    if x_direction is not None and np.dot(axis, x_direction) < 0:
+        axis = -axis
+    normal = np.array([-axis[1], axis[0]])
+
+    # Mid_MCP lies on the positive z side of the palm axis
+    bases = observed[:, 0]
+    handedness = 1.0 if np.dot(bases[FINGERS.index('middle')] - refs[0], normal) >= 0 else -1.0
+    normal = handedness * normal
+
+    # Along the axis: base = origin + s_x * default_x, across it the origin lies on the line of the palm refs
+    default_offsets = layout['default_offsets']
+    design = np.stack([np.ones(len(FINGERS)), default_offsets[:, 0]], axis=1)
+    (origin_x, scale_x), *_ = np.linalg.lstsq(design, bases @ axis, rcond=None)
+    origin_z = np.mean(refs @ normal)
+    scale_z = np.dot(bases @ normal - origin_z, default_offsets[:, 1]) / np.dot(default_offsets[:, 1], default_offsets[:, 1])
+    origin = origin_x * axis + origin_z * normal
+
+    model_bases = origin + scale_x * default_offsets[:, 0, None] * axis + scale_z * default_offsets[:, 1, None] * normal
+    chain = np.concatenate([model_bases[:, None], observed[:, 1:]], axis=1)
+    links = np.diff(chain, axis=1)
+    if layout['straight_fingers']:
+        # Direction from the base to the tip, the links are measured along it
+        span = chain[:, -1] - chain[:, 0]
+        angles = np.arctan2(span[:, 1], span[:, 0])
+        direction = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+        lengths = np.maximum(np.sum(links * direction[:, None], axis=-1), 0.0)
+    else:
+        lengths = np.linalg.norm(links, axis=-1)
+        angles = np.arctan2(links[..., 1], links[..., 0])
+
+    params = np.concatenate([
+        [np.arctan2(axis[1], axis[0])],
+        origin,
+        [scale_x, scale_z],
+        lengths.reshape(-1),
+        angles.reshape(-1),
+    ])
+    return params, handedness
+
+# Jacobian by central differences, all perturbed parameter vectors are evaluated in one batch
+def __jacobian(residual_fn, params):
+    steps = 1e-6 * np.maximum(1.0, np.abs(params))
+    batch = params[None] + np.concatenate([np.diag(steps), -np.diag(steps)])
+    r = residual_fn(batch)
+    return ((r[:len(params)] - r[len(params):]) / (2 * steps[:, None])).T
+
+# Minimizes the squared residuals with Levenberg-Marquardt, returns the parameters, iterations and convergence.
+# It has converged when the residuals vanish, are orthogonal to the jacobian or stop decreasing by more than tol
+def __levenbergMarquardt(residual_fn, params, max_iter, tol):
+    damping = 1e-3
+    residuals = residual_fn(params[None])[0]
+    cost = residuals @ residuals
+
+    for iteration in range(1, max_iter + 1):
+        jac = __jacobian(residual_fn, params)
+        jtj = jac.T @ jac
+        grad = jac.T @ residuals
+        cosine = np.abs(grad) / (np.linalg.norm(jac, axis=0) * np.sqrt(cost) + 1e-300)
+        if cost <= 1e-24 or np.max(cosine) <= 1e-8:
+            return params, iteration - 1, True
+
+        while True:
+            step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj) + 1e-12), -grad)
+            new_params = params + step
+            new_residuals = residual_fn(new_params[None])[0]
+            new_cost = new_residuals @ new_residuals
+            if new_cost < cost:
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+            if damping > 1e12:
+                # No step improves the cost anymore, the fit is stuck
+                return params, iteration, False
+
+        improvement = cost - new_cost
+        params, residuals, cost = new_params, new_residuals, new_cost
+        if improvement <= tol * cost or np.linalg.norm(step) <= tol * (np.linalg.norm(params) + tol):
+            return params, iteration, True
+
+    return params, max_iter, False
@@ -2,6 +2,9 @@ import cv2
 import yaml
 import numpy as np
 import distance_estimation
+import calib_export
+import keypoint_refinement
+import hand_model
 import os
 import argparse
 from grab_image import grab_image
@@ -36,6 +39,12 @@ class Circ:
         wname = 'circle'
         self.active = False
 
+        # Raw click of the operator and the sub-pixel position used for measurements, which defaults to the click
+        self.click_x = x
+        self.click_y = y
+        self.sub_x = float(x)
+        self.sub_y = float(y)
+
         self.keepWithin = Rect()
         self.keepWithin.x = 0
         self.keepWithin.y = 0
@@ -45,21 +54,42 @@ class Circ:
     def clicked_inside(self, x, y):
         return (x - self.x)**2 + (y - self.y)**2 < self.radius**2
 
+    @property
+    def pos(self):
+        return (self.sub_x, self.sub_y)
+
+    @property
+    def click(self):
+        return (self.click_x, self.click_y)
+
+    # Places the keypoint by hand, which replaces the click
+    def set_pos(self, x, y):
+        self.click_x = x
+        self.click_y = y
+        self.snap(x, y)
+
+    # Moves the measured position only, e.g. after refinement, and keeps the click
+    def snap(self, x, y):
+        self.sub_x = float(x)
+        self.sub_y = float(y)
+        self.x = int(round(x))
+        self.y = int(round(y))
+
 class Prog:
-    def __init__(self, image, cam_calibration) -> None:
+    def __init__(self, image, cam_calibration, dataset_path=None, subject='', refine=False, fit=False, straight_fingers=False) -> None:
         self.source = image
         self.image  = self.source.copy()
         self.cam_calib = cam_calibration
+        self.dataset_path = dataset_path
+        self.subject = subject
+        self.refine = refine
+        self.refine_responses = {}
+        self.fit_model = fit
+        self.straight_fingers = straight_fingers
+        self.model_fit = None
+        self.board_pose = None
 
-        self.keypoint_names = [
-            "palm_ref0",  "palm_ref1",
-            "Th_TM",      "Ind_MCP",    "Mid_MCP", "Ring_MCP", "Lit_MCP", 
-            "Th_MCP",     "Th_IP",      "Th_TIP",
-            "Ind_PIP",    "Ind_DIP",    "Ind_TIP",
-            "Mid_PIP",    "Mid_DIP",    "Mid_TIP",
-            "Ring_PIP",   "Ring_DIP",   "Ring_TIP",
-            "Lit_PIP", "Lit_DIP", "Lit_TIP",
-        ]
+        self.keypoint_names = list(calib_export.KEYPOINT_NAMES)
 
         self.keypoints = {}
         self.keypoint_idx = 0
@@ -87,6 +117,8 @@ class Prog:
             f"Double-Click LMB to Set the Next Keypoint ({self.keypoint_names[self.keypoint_idx]})",
             "You Can Drag a Keypoint with RMB to Reposition it",
             "Press `d` to toggle distance output",
+            "Press `r` to refine keypoints to sub-pixel accuracy",
+            "Press `f` to toggle hand model fitting",
         ]
         self.clearCanvasNDraw()
         while not self.done:
@@ -95,17 +127,31 @@ class Prog:
                     f"Double-Click LMB to Set the Next Keypoint ({self.keypoint_names[self.keypoint_idx]})",
                     "You Can Drag a Keypoint with RMB to Reposition it",
                     "Press `d` to toggle distance output",
+                    "Press `r` to refine keypoints to sub-pixel accuracy",
+                    "Press `f` to toggle hand model fitting",
                 ]
             else:
                 self.instructions = [
                     "You Can Drag a Keypoint with RMB to Reposition it",
-                    "Press `d` to toggle distance output"
+                    "Press `d` to toggle distance output",
+                    "Press `r` to refine keypoints to sub-pixel accuracy",
+                    "Press `f` to toggle hand model fitting",
                 ]
             key = cv2.waitKey(1) & 0xFF
             if key == ord("d"):
                 print("Pressed d!")
                 self.show_distances = not self.show_distances
                 self.clearCanvasNDraw()
+            if key == ord("r"):
+                print("Pressed r!")
+                self.refine_keypoints()
+                self.saved = False
+                self.clearCanvasNDraw()
+            if key == ord("f"):
+                print("Pressed f!")
+                self.fit_model = not self.fit_model
+                self.saved = False
+                self.clearCanvasNDraw()
             if key == ord(" ") and self.keypoint_idx > 19:
                 self.save_config()
             if key == ord("q"):
@@ -148,8 +194,46 @@ class Prog:
         x = max(0, min(self.image.shape[1], x))
         y = max(0, min(self.image.shape[0], y))
 
-        self.dragging.x = x
-        self.dragging.y = y
+        self.dragging.set_pos(x, y)
+
+    # Snaps the crease and contour keypoints, one batch per mode, from their clicks to the local response
+    def refine_keypoints(self):
+        moved = 0
+        for mode in set(keypoint_refinement.REFINE_MODES.values()):
+            circles = [circle for name, circle in self.keypoints.items() if keypoint_refinement.REFINE_MODES.get(name) == mode]
+            if len(circles) == 0:
+                continue
+            if mode not in self.refine_responses:
+                response = keypoint_refinement.compute_response(self.source, mode)
+                self.refine_responses[mode] = (response, keypoint_refinement.response_noise(response))
+            response, noise = self.refine_responses[mode]
+
+            refined, refined_mask = keypoint_refinement.refine_keypoints(
+                self.source,
+                [circle.click for circle in circles],
+                mode=mode,
+                response=response,
+                noise=noise
+            )
+            for circle, (x, y) in zip(circles, refined):
+                circle.snap(x, y)
+            moved += int(refined_mask.sum())
+        print(f"Refined {moved} keypoints, the others stay at their clicks")
+
+    # Fits the hand model to all keypoints at once in the board plane
+    def fit_keypoints(self):
+        if self.board_pose is None:
+            self.board_pose = distance_estimation.load_board_pose(self.cam_calib)
+
+        names = list(self.keypoints.keys())
+        world = distance_estimation.points_to_world([self.keypoints[name].pos for name in names], *self.board_pose)
+        points = dict(zip(names, world[:, :2]))
+
+        # Positive palm x offsets point downwards in the image, like the measured offsets in clearCanvasNDraw
+        x_direction = points['palm_ref1'] - points['palm_ref0']
+        if self.keypoints['palm_ref1'].sub_y < self.keypoints['palm_ref0'].sub_y:
+            x_direction = -x_direction
+        return hand_model.fit_hand_model(points, self.defalt_calib, x_direction=x_direction, straight_fingers=self.straight_fingers)
 
     def clearCanvasNDraw(self):
         self.image  = self.source.copy()
@@ -190,7 +274,7 @@ class Prog:
                 cv2.line(self.image, (ref.x, ref.y), (circle.x, circle.y), (255, 255, 255), 2)
 
                 if self.show_distances:
-                    text = f"{distance_estimation.estimate_distance((ref.x, ref.y), (circle.x, circle.y), self.cam_calib)*100:2.2f}cm"
+                    text = f"{distance_estimation.estimate_distance(ref.pos, circle.pos, self.cam_calib)*100:2.2f}cm"
                     textsize, _ = cv2.getTextSize(text, font, fontsize_dists, font_thickness)
                     cv2.putText(
                         self.image,
@@ -209,13 +293,14 @@ class Prog:
                 cv2.line(self.image, (keypoint_list[1][1].x, keypoint_list[1][1].y), (circle.x, circle.y), (0, 255, 0), 2)
             if name != 'Th_MCP' and ('MCP' in name or name == 'Th_TM'):
                 if self.show_distances and self.palm is not None:
-                    cv2.line(self.image, (self.palm[0], self.palm[1]), (circle.x, circle.y), (57, 127, 253), 2)
-                    text = f"{distance_estimation.estimate_distance(self.palm, (circle.x, circle.y), self.cam_calib)*100:2.2f}cm"
+                    palm_px = (int(round(self.palm[0])), int(round(self.palm[1])))
+                    cv2.line(self.image, palm_px, (circle.x, circle.y), (57, 127, 253), 2)
+                    text = f"{distance_estimation.estimate_distance(self.palm, circle.pos, self.cam_calib)*100:2.2f}cm"
                     textsize, _ = cv2.getTextSize(text, font, fontsize_dists, font_thickness)
                     cv2.putText(
                         self.image,
                         text,
-                        (circle.x - (circle.x - self.palm[0])//2 - textsize[0]//2, circle.y - (circle.y - self.palm[1])//2 - textsize[1]//2),
+                        (circle.x - (circle.x - palm_px[0])//2 - textsize[0]//2, circle.y - (circle.y - palm_px[1])//2 - textsize[1]//2),
                         font, 
                         fontsize_dists,
                         (0, 0, 255),
@@ -225,14 +310,20 @@ class Prog:
                 
                 if self.palm is not None:
                     proj = distance_estimation.project_point_on_line(
-                        np.array((keypoint_list[0][1].x, keypoint_list[0][1].y)),
-                        np.array((keypoint_list[1][1].x, keypoint_list[1][1].y)),
-                        np.array((circle.x, circle.y))
-                    ).astype(np.int16)
+                        np.array(keypoint_list[0][1].pos),
+                        np.array(keypoint_list[1][1].pos),
+                        np.array(circle.pos)
+                    )
                     x_off = distance_estimation.estimate_distance(self.palm, proj, self.cam_calib)
-                    z_off = distance_estimation.estimate_distance((circle.x, circle.y), proj, self.cam_calib)
+                    z_off = distance_estimation.estimate_distance(circle.pos, proj, self.cam_calib)
                     if proj[1] < self.palm[1]:
                         x_off *= -1
+                    # z is signed like in the hand model fit, negative on the other side of the palm axis than Mid_MCP
+                    ref0 = np.array(keypoint_list[0][1].pos)
+                    axis = np.array(keypoint_list[1][1].pos) - ref0
+                    side = lambda p: axis[0] * (p[1] - ref0[1]) - axis[1] * (p[0] - ref0[0])
+                    if side(circle.pos) * side(self.keypoints['Mid_MCP'].pos) < 0:
+                        z_off *= -1
 
                     c_name = get_palm_dist_calib_name(name)
                     self.calib_values['palm_link_distances'][c_name]['z'] = z_off
@@ -266,11 +357,12 @@ class Prog:
 
             # Make projection of palm_link
             if name == 'Mid_MCP':
-                self.palm = palm = distance_estimation.project_point_on_line(
-                    np.array((keypoint_list[0][1].x, keypoint_list[0][1].y)),
-                    np.array((keypoint_list[1][1].x, keypoint_list[1][1].y)),
-                    np.array((circle.x, circle.y))
-                ).astype(np.uint16)
+                self.palm = distance_estimation.project_point_on_line(
+                    np.array(keypoint_list[0][1].pos),
+                    np.array(keypoint_list[1][1].pos),
+                    np.array(circle.pos)
+                )
+                palm = (int(round(self.palm[0])), int(round(self.palm[1])))
 
                 textsize, _ = cv2.getTextSize('palm_link', font, fontsize_keypoints, font_thickness)
                 cv2.putText(
@@ -299,6 +391,14 @@ class Prog:
         if self.last_kp_active:
             cv2.putText(self.image, "Once you are happy with the keypoints, press space to generate a calibration file!", (x0, y0), font, fontsize_inst, (0, 0, 255), font_thickness, cv2.LINE_AA)
 
+        if self.fit_model and len(self.keypoints) == len(self.keypoint_names):
+            self.model_fit = self.fit_keypoints()
+            worst = max(self.model_fit['residuals'], key=self.model_fit['residuals'].get)
+            text = f"Hand model fit: rms {self.model_fit['rms']*1000:.2f}mm, max {self.model_fit['residuals'][worst]*1000:.2f}mm at {worst}"
+            if not self.model_fit['converged']:
+                text += " (not converged)"
+            cv2.putText(self.image, text, (50, self.image.shape[0] - 70), font, fontsize_inst, (0, 0, 255), font_thickness, cv2.LINE_AA)
+
         if self.save_path != '':
             if self.saved:
                 cv2.putText(self.image, f"Saved Config to: {self.save_path}", (50, self.image.shape[0] - 100), font, fontsize_inst, (0, 0, 255), font_thickness, cv2.LINE_AA)
@@ -308,7 +408,23 @@ class Prog:
         cv2.imshow(self.wName, self.image)
 
 
-    def save_config(self):
+    # Applies the hand model fitted to all keypoints at once to the calib, falls back to measuring every link
+    # independently if the fit did not converge
+    def apply_model_fit(self):
+        self.model_fit = self.fit_keypoints()
+        if not self.model_fit['converged']:
+            print(f"[WARNING]: hand model fit did not converge after {self.model_fit['iterations']} iterations, measuring the links independently instead")
+            self.measure_segments()
+            return
+        fitted = self.model_fit['calib']
+        for finger in hand_model.FINGERS:
+            self.calib_values[finger] = fitted[finger]
+            self.calib_values['palm_link_distances'][finger].update(fitted['palm_link_distances'][finger])
+        self.calib_values['scales'] = fitted['scales']
+        print(f"Fitted hand model in {self.model_fit['iterations']} iterations with rms {self.model_fit['rms']*1000:.2f}mm")
+
+    # Measures every link of the calib independently
+    def measure_segments(self):
 
         thumb  = dict()
         index  = dict()
@@ -323,9 +439,9 @@ class Prog:
         ip  = self.keypoints["Th_IP"]
         tip = self.keypoints["Th_TIP"]
 
-        thumb["proximal"] = distance_estimation.estimate_distance((tm.x, tm.y), self.palm, self.cam_calib)
-        thumb["middle"]   = distance_estimation.estimate_distance((ip.x, ip.y), (mcp.x, mcp.y), self.cam_calib)
-        thumb["distal"]   = distance_estimation.estimate_distance((tip.x, tip.y), (ip.x, ip.y), self.cam_calib)
+        thumb["proximal"] = distance_estimation.estimate_distance(tm.pos, self.palm, self.cam_calib)
+        thumb["middle"]   = distance_estimation.estimate_distance(ip.pos, mcp.pos, self.cam_calib)
+        thumb["distal"]   = distance_estimation.estimate_distance(tip.pos, ip.pos, self.cam_calib)
 
         scales['thumb']   = {k: thumb[k]/default for k, default in self.defalt_calib['thumb'].items()}
 
@@ -334,9 +450,9 @@ class Prog:
         dip = self.keypoints["Ind_DIP"]
         tip = self.keypoints["Ind_TIP"]
 
-        index["proximal"] = distance_estimation.estimate_distance((pip.x, pip.y), (mcp.x, mcp.y), self.cam_calib)
-        index["middle"]   = distance_estimation.estimate_distance((dip.x, dip.y), (pip.x, pip.y), self.cam_calib)
-        index["distal"]   = distance_estimation.estimate_distance((tip.x, tip.y), (dip.x, dip.y), self.cam_calib)
+        index["proximal"] = distance_estimation.estimate_distance(pip.pos, mcp.pos, self.cam_calib)
+        index["middle"]   = distance_estimation.estimate_distance(dip.pos, pip.pos, self.cam_calib)
+        index["distal"]   = distance_estimation.estimate_distance(tip.pos, dip.pos, self.cam_calib)
 
         scales['index']   = {k: index[k]/default for k, default in self.defalt_calib['index'].items()}
 
@@ -345,9 +461,9 @@ class Prog:
         dip = self.keypoints["Mid_DIP"]
         tip = self.keypoints["Mid_TIP"]
 
-        middle["proximal"] = distance_estimation.estimate_distance((pip.x, pip.y), (mcp.x, mcp.y), self.cam_calib)
-        middle["middle"]   = distance_estimation.estimate_distance((dip.x, dip.y), (pip.x, pip.y), self.cam_calib)
-        middle["distal"]   = distance_estimation.estimate_distance((tip.x, tip.y), (dip.x, dip.y), self.cam_calib)
+        middle["proximal"] = distance_estimation.estimate_distance(pip.pos, mcp.pos, self.cam_calib)
+        middle["middle"]   = distance_estimation.estimate_distance(dip.pos, pip.pos, self.cam_calib)
+        middle["distal"]   = distance_estimation.estimate_distance(tip.pos, dip.pos, self.cam_calib)
 
         scales['middle']   = {k: middle[k]/default for k, default in self.defalt_calib['middle'].items()}
 
@@ -356,9 +472,9 @@ class Prog:
         dip = self.keypoints["Ring_DIP"]
         tip = self.keypoints["Ring_TIP"]
 
-        ring["proximal"] = distance_estimation.estimate_distance((pip.x, pip.y), (mcp.x, mcp.y), self.cam_calib)
-        ring["middle"]   = distance_estimation.estimate_distance((dip.x, dip.y), (pip.x, pip.y), self.cam_calib)
-        ring["distal"]   = distance_estimation.estimate_distance((tip.x, tip.y), (dip.x, dip.y), self.cam_calib)
+        ring["proximal"] = distance_estimation.estimate_distance(pip.pos, mcp.pos, self.cam_calib)
+        ring["middle"]   = distance_estimation.estimate_distance(dip.pos, pip.pos, self.cam_calib)
+        ring["distal"]   = distance_estimation.estimate_distance(tip.pos, dip.pos, self.cam_calib)
 
         scales['ring']   = {k: ring[k]/default for k, default in self.defalt_calib['ring'].items()}
 
@@ -367,15 +483,14 @@ class Prog:
         dip = self.keypoints["Lit_DIP"]
         tip = self.keypoints["Lit_TIP"]
 
-        little["proximal"] = distance_estimation.estimate_distance((pip.x, pip.y), (mcp.x, mcp.y), self.cam_calib)
-        little["middle"]   = distance_estimation.estimate_distance((dip.x, dip.y), (pip.x, pip.y), self.cam_calib)
-        little["distal"]   = distance_estimation.estimate_distance((tip.x, tip.y), (dip.x, dip.y), self.cam_calib)
+        little["proximal"] = distance_estimation.estimate_distance(pip.pos, mcp.pos, self.cam_calib)
+        little["middle"]   = distance_estimation.estimate_distance(dip.pos, pip.pos, self.cam_calib)
+        little["distal"]   = distance_estimation.estimate_distance(tip.pos, dip.pos, self.cam_calib)
 
         scales['little']   = {k: little[k]/default for k, default in self.defalt_calib['little'].items()}
 
         scales['palm'] = {k: self.calib_values['palm_link_distances']['little'][k]/self.defalt_calib['palm_link_distances']['little'][k] for k in ['z','x']}
 
-
         self.calib_values['thumb']     = thumb
         self.calib_values['index']     = index 
         self.calib_values['middle']    = middle 
@@ -383,12 +498,33 @@ class Prog:
         self.calib_values['little']    = little
         self.calib_values['scales']    = scales
 
+    def save_config(self):
+        if self.refine:
+            self.refine_keypoints()
+            self.clearCanvasNDraw()
+
+        if self.fit_model:
+            self.apply_model_fit()
+        else:
+            self.measure_segments()
+
         with open('handcalib.yaml', 'w') as f:
             yaml.dump(self.calib_values, f, default_flow_style=False)
             self.save_path = os.path.abspath(f.name)
             self.saved = True
             print(f"Saved calib under path: {self.save_path}")
 
+        if self.dataset_path is not None:
+            row = calib_export.make_row(
+                self.calib_values,
+                keypoints={name: circle.click for name, circle in self.keypoints.items()},
+                subject=self.subject,
+                source=self.save_path,
+                camera_calibration=os.path.abspath(self.cam_calib)
+            )
+            calib_export.append_rows(self.dataset_path, [row])
+            print(f"Appended calib to dataset: {os.path.abspath(self.dataset_path)}")
+
 if __name__ == '__main__':
     dirname = os.path.dirname(__file__)
     default_calib = os.path.normpath(os.path.join(dirname, os.pardir, 'calibration.npy'))
@@ -399,6 +535,11 @@ if __name__ == '__main__':
     ex_group.add_argument('-d', '--device', type=int, help="Camera device number (defaults to 0)", default=0)
     ex_group.add_argument('-i', '--image', help="Path to image to load")
     parser.add_argument('-c', '--calibration', type=str, help=f"Path to camera calibration (defaults to {default_calib})", default=default_calib)
+    parser.add_argument('-o', '--dataset', type=str, help="Path of a csv dataset to append each saved calib to (optional)", default=None)
+    parser.add_argument('-r', '--refine', action='store_true', help="Refine all keypoints to sub-pixel accuracy before saving")
+    parser.add_argument('-f', '--fit', action='store_true', help="Fit the hand model to all keypoints at once instead of measuring every link independently")
+    parser.add_argument('--straight_fingers', action='store_true', help="Fit all links of a finger along one direction (hand lying flat)")
+    parser.add_argument('-s', '--subject', type=str, help="Subject name stored with the calib in the dataset", default='')
 
     args = parser.parse_args()
     print(args)
@@ -413,4 +554,4 @@ if __name__ == '__main__':
     else:
         image = grab_image(args.device)
 
-    Prog(image, args.calibration)
\ No newline at end of file
+    Prog(image, args.calibration, dataset_path=args.dataset, subject=args.subject, refine=args.refine, fit=args.fit, straight_fingers=args.straight_fingers)
\ No newline at end of file
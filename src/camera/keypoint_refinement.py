@@ -0,0 +1,115 @@
+import cv2
+import numpy as np
+
+
+# Keypoints that lie on a joint crease (dark valley) or on the finger contour (edge).
+# MCPs, Th_TM and the palm refs usually have no such evidence and are left where they were clicked
+REFINE_MODES = {
+    "Th_MCP":  'crease', "Th_IP":    'crease', "Th_TIP":   'edge',
+    "Ind_PIP": 'crease', "Ind_DIP":  'crease', "Ind_TIP":  'edge',
+    "Mid_PIP": 'crease', "Mid_DIP":  'crease', "Mid_TIP":  'edge',
+    "Ring_PIP": 'crease', "Ring_DIP": 'crease', "Ring_TIP": 'edge',
+    "Lit_PIP": 'crease', "Lit_DIP":  'crease', "Lit_TIP":  'edge',
+}
+
+
+### PUBLIC FUNCTIONS ###
+
+# Computes the response map of a mode: the signed Laplacian of Gaussian, positive in dark valleys, for 'crease'
+# and the gradient magnitude for 'edge'
+def compute_response(image, mode='crease', sigma=1.5):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(image.astype(np.float32), (0, 0), sigma)
+    if mode == 'crease':
+        return cv2.Laplacian(blurred, cv2.CV_32F, ksize=3)
+    if mode == 'edge':
+        gx = cv2.Sobel(blurred, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(blurred, cv2.CV_32F, 0, 1, ksize=3)
+        return cv2.magnitude(gx, gy)
+    raise ValueError(f'Unknown refinement mode: {mode}')
+
+# Robust estimate of the noise level of a response map (scaled median absolute deviation)
+def response_noise(response):
+    return 1.4826 * float(np.median(np.abs(response - np.median(response))))
+
+# Snaps keypoints at once to the sub-pixel maximum of the response in a small window around them.
+# points is a (N, 2) array of (x, y) pixel coordinates, returns a (N, 2) float array and a (N,) mask of moved points.
+# A point is left where it was if the maximum is no local maximum across the line (the crease lies outside of the
+# window), or if it does not exceed the window median by min_contrast times the noise level of the response.
+def refine_keypoints(image, points, mode='crease', window=3, sigma=1.5, min_contrast=6.0, response=None, noise=None):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return points, np.zeros(0, dtype=bool)
+    if response is None:
+        response = compute_response(image, mode, sigma)
+    if noise is None:
+        noise = response_noise(response)
+    height, width = response.shape
+
+    # Pad the response so that every window and the 3x3 peak neighbourhood stay inside the array
+    pad = window + 1
+    padded = cv2.copyMakeBorder(response, pad, pad, pad, pad, cv2.BORDER_REPLICATE)
+
+    centers = np.round(points).astype(np.int64)
+    centers[:, 0] = np.clip(centers[:, 0], 0, width - 1)
+    centers[:, 1] = np.clip(centers[:, 1], 0, height - 1)
+
+    # Gather all windows as one (N, 2*window+1, 2*window+1) array
+    offsets = np.arange(-window, window + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+    patches = padded[centers[:, 1, None, None] + dy + pad, centers[:, 0, None, None] + dx + pad].reshape(len(points), -1)
+
+    peak = patches.argmax(axis=1)
+    peak_y, peak_x = np.unravel_index(peak, dx.shape)
+    contrast = patches[np.arange(len(points)), peak] - np.median(patches, axis=1)
+    moved = contrast > min_contrast * max(noise, 1e-6)
+
+    peak_x = centers[:, 0] + offsets[peak_x]
+    peak_y = centers[:, 1] + offsets[peak_y]
+
+    # Creases and edges are lines, so only move across them: the normal is the direction of the strongest
+    # negative curvature of the response at the peak, the sub-pixel offset a Newton step along it
+    normal, ridge, offset = __lineNormal(padded, peak_x + pad, peak_y + pad)
+    moved &= ridge
+
+    # The neighbours across the line must not be stronger, otherwise the window only touches the flank of the line
+    step = np.round(normal).astype(np.int64)
+    c = padded[peak_y + pad, peak_x + pad]
+    moved &= padded[peak_y + pad + step[:, 1], peak_x + pad + step[:, 0]] <= c
+    moved &= padded[peak_y + pad - step[:, 1], peak_x + pad - step[:, 0]] <= c
+
+    target = np.stack([peak_x, peak_y], axis=1) + offset[:, None] * normal
+    shift = np.sum((target - points) * normal, axis=1)
+    moved &= np.abs(shift) <= window
+
+    refined = points.copy()
+    refined[moved] = points[moved] + shift[moved, None] * normal[moved]
+    refined[:, 0] = np.clip(refined[:, 0], 0, width - 1)
+    refined[:, 1] = np.clip(refined[:, 1], 0, height - 1)
+    return refined, moved
+
+
+### PRIVATE FUNCTIONS ###
+
+# Returns the unit normal (N, 2), whether the response is a ridge (the negative curvature across dominates the one
+# along the line) and the sub-pixel offset in [-0.5, 0.5] along the normal of the response peaks at the given
+# (padded) positions, using central differences
+def __lineNormal(response, x, y):
+    c = response[y, x]
+    gx = 0.5 * (response[y, x + 1] - response[y, x - 1])
+    gy = 0.5 * (response[y + 1, x] - response[y - 1, x])
+    hxx = response[y, x + 1] - 2 * c + response[y, x - 1]
+    hyy = response[y + 1, x] - 2 * c + response[y - 1, x]
+    hxy = 0.25 * (response[y + 1, x + 1] - response[y - 1, x + 1] - response[y + 1, x - 1] + response[y - 1, x - 1])
+
+    # Eigenvector of the smaller eigenvalue of the hessian
+    theta = 0.5 * np.arctan2(2 * hxy, hxx - hyy) + 0.5 * np.pi
+    normal = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+    curvature = 0.5 * (hxx + hyy) - np.sqrt((0.5 * (hxx - hyy))**2 + hxy**2)
+
+    ridge = (curvature < 0) & (hxx + hyy < 0)
+
+    offset = np.zeros_like(curvature, dtype=np.float64)
+    offset[ridge] = -(gx[ridge] * normal[ridge, 0] + gy[ridge] * normal[ridge, 1]) / curvature[ridge]
+    return normal, ridge, np.clip(offset, -0.5, 0.5)